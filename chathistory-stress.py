@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import zlib
+import base64
+import struct
+import random
+import tempfile
+import threading
+import http.server
+import argparse
+
+import chathistory
+
+
+CHAT_TEMPLATE = """{% for message in messages %}<|{{message['role']}}|>
+{{message['content']}}
+{% endfor %}{% if add_generation_prompt %}<|assistant|>
+{% endif %}"""
+MOCK_TOKENS = ['Hello', ' there', '.', '\n']
+WORDS = ['the', 'dragon', 'village', 'sword', 'night', 'river', 'castle', 'whispered', 'slowly', 'under']
+
+
+class MockBackendHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        for token in MOCK_TOKENS:
+            event = {'content': token, 'stop': False}
+            self.wfile.write(f'data: {json.dumps(event)}\n\n'.encode('utf-8'))
+        self.wfile.write(b'data: {"content": "", "stop": true}\n\n')
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_mock_backend():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), MockBackendHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_address[1]}/completion'
+
+
+def png_chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+
+def write_card(path, card_pixels, description_size):
+    # Noise pixels keep the image data from compressing, like real card art.
+    card = {
+        'data': {
+            'name': 'Narrator',
+            'description': random_text(description_size),
+            'personality': 'Calm.',
+            'scenario': 'A long journey.',
+            'mes_example': '<START>\nNarrator: Welcome.',
+        },
+    }
+    chara = base64.b64encode(json.dumps(card).encode('utf-8'))
+    row_size = card_pixels * 3
+    rows = b''.join(b'\x00' + os.urandom(row_size) for _ in range(card_pixels))
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(png_chunk(b'IHDR', struct.pack('>IIBBBBB', card_pixels, card_pixels, 8, 2, 0, 0, 0)))
+        f.write(png_chunk(b'tEXt', b'chara\x00' + chara))
+        f.write(png_chunk(b'IDAT', zlib.compress(rows, 1)))
+        f.write(png_chunk(b'IEND', b''))
+
+
+def random_text(size):
+    words = []
+    length = 0
+    while length < size:
+        word = random.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return ' '.join(words)
+
+
+def write_chat(path, message_count, message_size):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('---\nprofile: stress\n---\n')
+        for i in range(message_count):
+            name = 'Traveler' if i % 2 == 0 else 'Narrator'
+            f.write(f'@{name}\n{random_text(message_size)}\n\n')
+        f.write('@Traveler\nWhat happens next?\n')
+
+
+def write_config(directory, api_url):
+    config = {
+        'profile': 'stress',
+        'profiles': {'stress': {}},
+        'user': 'Traveler',
+        'api_mode': 'llamacpp-completion',
+        'api_url': api_url,
+        'api_call_props': {'stream': True},
+        'chat_template': CHAT_TEMPLATE,
+        # Keep stress runs out of the user's usage ledger.
+        'usage_ledger_file': None,
+    }
+    with open(os.path.join(directory, '.chathistory'), 'w') as f:
+        json.dump(config, f)
+    with open(os.path.join(directory, 'sys-prompt.txt'), 'w') as f:
+        f.write('{{insert_charcard_png card.png}}\n')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='1000,5000,20000,50000')
+    parser.add_argument('--message-size', type=int, default=400)
+    parser.add_argument('--card-pixels', type=int, default=2048)
+    parser.add_argument('--card-description-size', type=int, default=20000)
+    args = parser.parse_args()
+
+    sizes = [int(x) for x in args.sizes.split(',')]
+    mib = 1024 * 1024
+    random.seed(0)
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        write_config(directory, start_mock_backend())
+        write_card(os.path.join(directory, 'card.png'), args.card_pixels, args.card_description_size)
+        chathistory.MEMORY_PROFILER.start()
+
+        rows = []
+        for size in sizes:
+            chat_path = os.path.join(directory, f'chat-{size}.txt')
+            write_chat(chat_path, size, args.message_size)
+            chat_size = os.path.getsize(chat_path)
+
+            chathistory.MEMORY_PROFILER.reset()
+            chathistory.run_with_file(chat_path, None)
+            stages = [x for x in chathistory.MEMORY_PROFILER.stages if x[1] == 0]
+            rows.append((size, chat_size, stages))
+
+    stage_names = [x[0] for x in rows[0][2]]
+    header = f"{'messages':>9} {'chat MiB':>9} " + ' '.join(f'{x:>17}' for x in stage_names)
+    print('Peak MiB per stage')
+    print(header)
+    for size, chat_size, stages in rows:
+        peaks = ' '.join(f'{x[4] / mib:17.1f}' for x in stages)
+        print(f'{size:9d} {chat_size / mib:9.1f} {peaks}')
+
+
+if __name__ == "__main__":
+    main()
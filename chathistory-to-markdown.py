@@ -6,6 +6,8 @@ import time
 import yaml
 import argparse
 
+import chathistory
+
 
 SLEEP_TIME = 0.2
 PROMPT_ROLES = ['system', 'user', 'assistant']
@@ -92,6 +94,13 @@ def parse_data_and_chathistory(text):
     return(data, history)
 
 
+def load_archived_history(chat_path):
+    history = []
+    for segment_path in chathistory.list_archive_segments(chat_path):
+        history += parse_chathistory(chathistory.read_archive_segment(segment_path))
+    return history
+
+
 def render_template(template, user):
     if user:
         processed_template = template.replace("{{user}}", user)
@@ -99,24 +108,22 @@ def render_template(template, user):
 
 
 def roleplays_to_markdown(history):
-    ret = ''
-
-    for message in history:
-        ret += f'### {message['name']}\n'
-        ret += message['content']
-        ret += '\n\n'
-
-    return ret
+    return ''.join(f'### {x['name']}\n{x['content']}\n\n' for x in history)
 
 
-def handle_updated_prompt(path):
-    base_path = os.path.dirname(path)
-
+def chathistory_to_markdown(path, base_path):
     with open(path, 'r', encoding='utf-8') as f:
         content = f.read()
     config_content, history = parse_data_and_chathistory(content)
 
+    # Put archived messages back after the leading system messages.
+    start = 0
+    while start < len(history) and history[start]['name'] == 'system':
+        start += 1
+    history[start:start] = load_archived_history(path)
+
     # Merge default config, user config, and .chathistory config .
+    config_file = {}
     config_file_path = find_dot_config_file(base_path, '.chathistory')
     if config_file_path:
         with open(config_file_path) as f:
@@ -124,6 +131,7 @@ def handle_updated_prompt(path):
 
     config_tmp = config_file.copy()
     config_tmp.update(config_content)
+    config_profile = {}
     if config_tmp.get('profile'):
         config_profile = config_tmp['profiles'][config_tmp['profile']]
 
@@ -132,14 +140,20 @@ def handle_updated_prompt(path):
     config.update(config_profile)
     config.update(config_content)
 
-    user = config['user']
+    return history_to_markdown(config['user'], history)
+
 
+def history_to_markdown(user, history):
     # Render chathistory templates.
     for x in history:
         x['content'] = render_template(x['content'], user)
         x['content'] = x['content'].strip('\n')
 
-    markdown = roleplays_to_markdown(history)
+    return roleplays_to_markdown(history)
+
+
+def handle_updated_prompt(path):
+    markdown = chathistory_to_markdown(path, os.path.dirname(path))
     with open('_markdown.md', 'w') as f:
         f.write(markdown)
 
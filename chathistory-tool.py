@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import runpy
+import argparse
+
+import chathistory
+
+
+SCRIPT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS = {}
+
+
+def script_function(filename, name):
+    # The sibling scripts are loaded once. The card scripts' own
+    # extract_ai_card_data is bypassed in favor of the cached one.
+    if filename not in SCRIPTS:
+        SCRIPTS[filename] = runpy.run_path(os.path.join(SCRIPT_DIRECTORY, filename))
+    return SCRIPTS[filename][name]
+
+
+def run_generate(path, args):
+    # A cancelled turn is restarted right away with the edited file.
+    cancelled = True
+    while cancelled:
+        cancelled = chathistory.run_with_file(path, args.template_directory, watching=args.watch)
+
+
+def run_markdown(path, args):
+    # Unlike chathistory-to-markdown.py, which always writes _markdown.md, each
+    # chat gets its own <chat>.md so many paths don't overwrite each other. The
+    # suffix is added to the full path, so a chat named *.md isn't replaced.
+    _, config_content, history = chathistory.read_chat(path)
+    config = chathistory.load_config(os.getcwd(), config_content)
+
+    # Put archived messages back after the leading system messages.
+    start = chathistory.leading_system_count(history)
+    history[start:start] = chathistory.load_archived_history(path)
+
+    history_to_markdown = script_function('chathistory-to-markdown.py', 'history_to_markdown')
+    markdown = history_to_markdown(config['user'], [{'name': x.name, 'content': x.content} for x in history])
+    with open(f'{path}.md', 'w') as f:
+        f.write(markdown)
+
+
+def run_archive(path, args):
+    _, config_content, _ = chathistory.read_chat(path)
+    config = chathistory.load_config(os.getcwd(), config_content)
+    chathistory.archive_chat(path, config['archive_keep'], config['archive_compression'])
+
+
+def run_card_json(path, args):
+    print(json.dumps(chathistory.extract_ai_card_data(path), indent=2))
+
+
+def run_card_txt(path, args):
+    create_chatml_prompt = script_function('charcard-png-to-txt.py', 'create_chatml_prompt')
+    print(create_chatml_prompt(chathistory.extract_ai_card_data(path)))
+
+
+def run_card_book(path, args):
+    create_chatml_prompt = script_function('charcard-png-to-char-book.py', 'create_chatml_prompt')
+    print(create_chatml_prompt(chathistory.extract_ai_card_data(path)))
+
+
+def run_card_openings(path, args):
+    create_chatml_prompt = script_function('charcard-png-to-openings.py', 'create_chatml_prompt')
+    create_chatml_prompt(chathistory.extract_ai_card_data(path))
+
+
+COMMANDS = {
+    'generate': run_generate,
+    'markdown': run_markdown,
+    'archive': run_archive,
+    'card-json': run_card_json,
+    'card-txt': run_card_txt,
+    'card-book': run_card_book,
+    'card-openings': run_card_openings,
+}
+
+
+def run_commands(commands, path, args):
+    for command in commands:
+        try:
+            COMMANDS[command](path, args)
+        except Exception as e:
+            print(f"{command} {path}: {e!r}", file=sys.stderr)
+            if not args.keep_going:
+                raise
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run chathistory commands on many files in one process. "
+                    "Chats, configs and cards are parsed once and shared "
+                    "between commands.",
+    )
+    parser.add_argument('commands', help=f"comma separated list of: {', '.join(COMMANDS)}. "
+                                          "markdown writes <chat>.md next to each chat, e.g. chat.txt.md.")
+    parser.add_argument('paths', nargs='+')
+    parser.add_argument('-w', '--watch', action='store_true', help="run the commands again whenever a path changes")
+    parser.add_argument('-t', '--template-directory')
+    parser.add_argument('-k', '--keep-going', action='store_true', help="continue with the next path after an error")
+    args = parser.parse_args()
+
+    commands = args.commands.split(',')
+    for command in commands:
+        if command not in COMMANDS:
+            parser.error(f"unknown command: {command}")
+
+    if args.watch:
+        for path in chathistory.watch_and_do(*args.paths):
+            run_commands(commands, path, args)
+
+    for path in args.paths:
+        run_commands(commands, path, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,72 @@
 #!/usr/bin/env python3
 
 import os
+import io
 import sys
+import math
 import json
 import re
+import html
 import time
+import queue
 import yaml
 import base64
+import bisect
+import glob
+import gzip
+import hashlib
+import itertools
+import collections
+import socket
+import zlib
+import threading
+import http.client
+import http.server
+import urllib.error
+import urllib.parse
 import urllib.request
 import argparse
 import datetime
+import copy
+import contextlib
+import tracemalloc
+import concurrent.futures
 
 import PIL.Image
 import jinja2
 import jinja2.sandbox
 import jinja2.ext
 
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 # import http.client
 # http.client.HTTPConnection.debuglevel = 1
 
 SLEEP_TIME = 0.2
+READ_CHUNK_SIZE = 65536
+SSE_LINE_END_RE = re.compile(rb'\r\n|\r|\n')
+RETRIEVAL_TOKEN_RE = re.compile(r'\w+')
+RETRIEVAL_HASH_BITS = 20
+RETRIEVAL_MERGE_SIZE = 65536
+INCREMENTAL_VERIFY_INTERVAL = 20
+INCREMENTAL_CACHE_SIZE = 64
+BM25_K1 = 1.2
+BM25_B = 0.75
+CHARS_PER_TOKEN = 4
 PROMPT_ROLES = ['system', 'user', 'assistant']
 DEFAULT_CHARCARD_TEMPLATE = """{{description}}
 {{personality}}
@@ -33,6 +80,40 @@ EXAMPLE MESSAGES:
 {% endfor %}
 {% endif %}
 """
+PREVIEW_KEEPALIVE_TIME = 15
+PREVIEW_PAGE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>chathistory</title>
+<style>
+body { font-family: sans-serif; max-width: 50em; margin: auto; }
+pre { white-space: pre-wrap; font-family: inherit; }
+</style>
+</head>
+<body>
+<div id="history"></div>
+<pre id="live"></pre>
+<script>
+const historyElement = document.getElementById('history');
+const liveElement = document.getElementById('live');
+const events = new EventSource('/events');
+events.addEventListener('history', (e) => {
+  historyElement.innerHTML = JSON.parse(e.data);
+  liveElement.textContent = '';
+  window.scrollTo(0, document.body.scrollHeight);
+});
+events.addEventListener('delta', (e) => {
+  liveElement.textContent += JSON.parse(e.data);
+  window.scrollTo(0, document.body.scrollHeight);
+});
+</script>
+</body>
+</html>
+"""
+DEFAULT_SUMMARY_PROMPT = """Summarize the following roleplay conversation. Keep \
+names, important facts, open plot threads and the current situation. Be \
+concise."""
 DEFAULT_SETTINGS = {
     'active': True,
     'user': 'user',
@@ -48,9 +129,91 @@ DEFAULT_SETTINGS = {
     'charcard_template': DEFAULT_CHARCARD_TEMPLATE,
     'character_book_png': None,
     'system_prompt_file': 'sys-prompt.txt',
+    'prewarm': False,
+    'prewarm_api_url': None,
+    'summarize_horizon': None,
+    'summarize_chunk': 20,
+    'summary_prompt': DEFAULT_SUMMARY_PROMPT,
+    'summary_cache_file': '.chathistory-summaries.json',
+    'write_debug_files': True,
+    'incremental_chat_template': False,
+    'retrieval_top_k': None,
+    'retrieval_horizon': 20,
+    'retrieval_query_messages': 3,
+    'retrieval_token_budget': 1024,
+    'early_stop_on_user': False,
+    'early_stop_names': [],
+    'archive_keep': 200,
+    'archive_compression': 'zstd',
+    'usage_ledger_file': None,
 }
 
 
+class MemoryProfiler:
+    # Records tracemalloc usage per named stage. Stages can nest; an enclosing
+    # stage's peak includes the peaks of the stages inside it.
+    def __init__(self):
+        self.enabled = False
+        self.stages = []
+        self.peaks = []
+        self.snapshot = None
+
+    def start(self):
+        tracemalloc.start(10)
+        self.enabled = True
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        if self.peaks:
+            self.peaks[-1] = max(self.peaks[-1], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+        start = tracemalloc.get_traced_memory()[0]
+        self.peaks.append(start)
+        index = len(self.stages)
+        self.stages.append(None)
+        try:
+            yield
+        finally:
+            end, peak = tracemalloc.get_traced_memory()
+            peak = max(peak, self.peaks.pop())
+            self.stages[index] = (name, len(self.peaks), start, end, peak)
+            if self.peaks:
+                self.peaks[-1] = max(self.peaks[-1], peak)
+            elif self.snapshot is None or end > self.snapshot[0]:
+                # Keep the allocations of the top level stage that left the
+                # most memory behind.
+                self.snapshot = (end, tracemalloc.take_snapshot())
+
+    def report(self, limit=10):
+        mib = 1024 * 1024
+        print("Memory by stage (start -> end, peak):", file=sys.stderr)
+        for name, depth, start, end, peak in self.stages:
+            label = '  ' * depth + name
+            print(f"  {label:<24} {start / mib:9.1f} -> {end / mib:9.1f} MiB, peak {peak / mib:9.1f} MiB", file=sys.stderr)
+
+        if self.snapshot is not None:
+            snapshot = self.snapshot[1].filter_traces([
+                tracemalloc.Filter(False, tracemalloc.__file__),
+            ])
+            print("Top allocation sites:", file=sys.stderr)
+            for stat in snapshot.statistics('lineno')[:limit]:
+                frame = stat.traceback[0]
+                print(f"  {stat.size / mib:9.1f} MiB {stat.count:9d} blocks  {frame.filename}:{frame.lineno}", file=sys.stderr)
+
+        self.reset()
+
+    def reset(self):
+        self.stages = []
+        self.snapshot = None
+
+
+MEMORY_PROFILER = MemoryProfiler()
+
+
 def find_dot_config_file(base_path, filename):
     current_dir = base_path
     home_dir = os.path.expanduser("~")
@@ -70,34 +233,348 @@ def find_dot_config_file(base_path, filename):
         current_dir = parent_dir
 
 
-def generate_api_data_lines(req):
+class GenerationCancelled(Exception):
+    pass
+
+
+class StreamCancel:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cancelled = False
+        self.conn = None
+
+    def attach(self, conn):
+        with self.lock:
+            self.conn = conn
+            cancelled = self.cancelled
+        if cancelled:
+            abort_connection(conn)
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            conn = self.conn
+        if conn is not None:
+            abort_connection(conn)
+
+
+def abort_connection(conn):
+    # shutdown() wakes up a read blocked in another thread and drops the
+    # connection right away, so the server frees the slot. close() alone waits
+    # for that read to return.
     try:
-        resp = urllib.request.urlopen(req)
-    except Exception as e:
-        breakpoint()
-        print('hi', file=sys.stderr)
-    full_log = open("_response.json", "wb")
-    for line_binary in resp:
-        full_log.write(line_binary)
-        line = line_binary.decode("utf-8").strip()
-        if not line:
-            continue
-        if line == ': keep-alive':
-            continue
-        assert(line.startswith("data: "))
-        yield json.loads(line[6:])
-    full_log.close()
+        sock = socket.socket(fileno=os.dup(conn.fileno()))
+    except OSError:
+        # Already closed, there is nothing left to abort.
+        return
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    finally:
+        sock.close()
+
+
+def file_stat(path):
+    st = os.stat(path)
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+class FileCache:
+    # Keeps what was loaded from a file until the file changes on disk.
+    def __init__(self, load):
+        self.load = load
+        self.entries = {}
+
+    def put(self, path, value):
+        # For values the process wrote to the file itself.
+        self.entries[os.path.abspath(path)] = (file_stat(path), value)
+
+    def get(self, path):
+        key = os.path.abspath(path)
+        stat = file_stat(path)
+        entry = self.entries.get(key)
+        if entry is None or entry[0] != stat:
+            entry = (stat, self.load(path))
+            self.entries[key] = entry
+        return entry[1]
+
+
+class ChatFileWatcher:
+    # Cancels a request as soon as anyone else modifies the chat file.
+    def __init__(self, path, cancel, last_stat):
+        self.path = path
+        self.cancel = cancel
+        self.lock = threading.Lock()
+        self.last_stat = last_stat
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.watch, daemon=True)
+        self.thread.start()
+
+    def is_modified(self):
+        return file_stat(self.path) != self.last_stat
+
+    def watch(self):
+        while not self.stopped.wait(SLEEP_TIME):
+            with self.lock:
+                modified = self.is_modified()
+            if modified:
+                self.cancel.cancel()
+                return
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+class ChatFileAppender(ChatFileWatcher):
+    # Appends generated text to a chat file, edits by anyone else cancel the
+    # generation. Text is held back until flushed, so an edit saved in
+    # between drops it instead of appending it to the edited file.
+    def __init__(self, path, f, cancel, last_stat):
+        self.f = f
+        self.pending = []
+        super().__init__(path, cancel, last_stat)
+
+    def check_modified(self):
+        if self.cancel.cancelled or self.is_modified():
+            self.pending = []
+            self.cancel.cancel()
+            raise GenerationCancelled()
+
+    def write(self, text):
+        with self.lock:
+            self.check_modified()
+            self.pending.append(text)
+
+    def flush(self):
+        with self.lock:
+            self.check_modified()
+            self.f.write(''.join(self.pending))
+            self.pending = []
+            self.f.flush()
+            self.last_stat = file_stat(self.path)
+
+
+def log_chunks(chunks, f):
+    for chunk in chunks:
+        f.write(chunk)
+        yield chunk
+
+
+def parse_sse_events(chunks):
+    # Server-sent events as in the HTML spec: lines end in CRLF, CR or LF,
+    # multiple data lines are joined with newlines, lines starting with ':' are
+    # comments and a blank line dispatches the event.
+    leftover = b''
+    event = b''
+    data = []
+
+    def parse_lines(lines):
+        nonlocal event, data
+        for line in lines:
+            if not line:
+                if data:
+                    yield (event or b'message', b'\n'.join(data))
+                event = b''
+                data = []
+                continue
+
+            if line.startswith(b':'):
+                continue
+
+            field, _, value = line.partition(b':')
+            if value.startswith(b' '):
+                value = value[1:]
+            if field == b'data':
+                data.append(value)
+            elif field == b'event':
+                event = value
+
+    for chunk in chunks:
+        buf = leftover + chunk
+        # A trailing CR may be the first half of a CRLF.
+        held = b''
+        if buf.endswith(b'\r'):
+            buf = buf[:-1]
+            held = b'\r'
+        lines = SSE_LINE_END_RE.split(buf)
+        leftover = lines.pop() + held
+        yield from parse_lines(lines)
+
+    # Be lenient with servers that close the stream without a final blank
+    # line.
+    yield from parse_lines([leftover.rstrip(b'\r'), b''])
+
+
+class ForwardProxyConnection(http.client.HTTPConnection):
+    # Plain HTTP through a proxy, requests name the full URL.
+    def __init__(self, host, port, proxy_headers):
+        super().__init__(host, port)
+        self.proxy_headers = proxy_headers
+
+
+def open_api_connection(url):
+    parts = urllib.parse.urlsplit(url)
+
+    # Proxies from the environment apply as they do for urllib, which sends
+    # the summary requests.
+    proxy = urllib.request.getproxies().get(parts.scheme)
+    if proxy and urllib.request.proxy_bypass(parts.netloc):
+        proxy = None
+
+    if proxy is None:
+        if parts.scheme == 'https':
+            conn = http.client.HTTPSConnection(parts.hostname, parts.port)
+        else:
+            conn = http.client.HTTPConnection(parts.hostname, parts.port)
+    else:
+        if '://' not in proxy:
+            proxy = f'http://{proxy}'
+        proxy_parts = urllib.parse.urlsplit(proxy)
+        proxy_headers = {}
+        if proxy_parts.username:
+            credentials = f'{urllib.parse.unquote(proxy_parts.username)}:{urllib.parse.unquote(proxy_parts.password or '')}'
+            proxy_headers['Proxy-Authorization'] = 'Basic ' + base64.b64encode(credentials.encode('utf-8')).decode('ascii')
+        if parts.scheme == 'https':
+            conn = http.client.HTTPSConnection(proxy_parts.hostname, proxy_parts.port)
+            conn.set_tunnel(parts.hostname, parts.port, proxy_headers)
+        else:
+            conn = ForwardProxyConnection(proxy_parts.hostname, proxy_parts.port, proxy_headers)
+    conn.connect()
+    conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return conn
+
+
+def preconnect(url):
+    # Resolve, connect and handshake in the background while the prompt is
+    # still being prepared.
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    future = executor.submit(open_api_connection, url)
+    executor.shutdown(wait=False)
+    return future
+
 
+def discard_preconnection(connection):
+    # Closes a preconnected connection that won't be used, once it is open.
+    def close(future):
+        if future.exception() is None:
+            future.result().close()
+    connection.add_done_callback(close)
+
+
+def send_preconnected_request(connection, url, headers, body, cancel=None):
+    conn = connection.result()
+    try:
+        return conn, send_api_request(conn, url, headers, body, cancel)
+    except ConnectionError:
+        if cancel is not None and cancel.cancelled:
+            raise GenerationCancelled()
+        conn.close()
+    except BaseException:
+        conn.close()
+        raise
+
+    # A server or proxy may drop a connection that sat idle while the prompt
+    # was prepared. Nothing was processed on it, so sending again is safe.
+    print("Connection was closed, reconnecting ...", file=sys.stderr)
+    conn = open_api_connection(url)
+    try:
+        return conn, send_api_request(conn, url, headers, body, cancel)
+    except BaseException:
+        conn.close()
+        raise
+
+
+def send_api_request(conn, url, headers, body, cancel=None):
+    parts = urllib.parse.urlsplit(url)
+    path = parts.path or '/'
+    if parts.query:
+        path += f'?{parts.query}'
+
+    request_headers = {'Content-Type': 'application/json'}
+    if isinstance(conn, ForwardProxyConnection):
+        path = urllib.parse.urldefrag(url).url
+        request_headers.update(conn.proxy_headers)
+    request_headers.update(headers)
+    conn.request('POST', path, body=body, headers=request_headers)
+
+    # Attach before waiting for the response headers, so a cancel also
+    # interrupts the prompt prefill.
+    if cancel is not None:
+        cancel.attach(conn.sock)
 
-def generate_openai_choices(req):
-    for json_data in generate_api_data_lines(req):
+    try:
+        resp = conn.getresponse()
+    except (OSError, http.client.HTTPException):
+        if cancel is not None and cancel.cancelled:
+            raise GenerationCancelled()
+        raise
+
+    if resp.status >= 400:
+        raise urllib.error.HTTPError(url, resp.status, resp.reason, resp.headers, resp)
+    return resp
+
+
+def generate_api_data_lines(resp, cancel=None, log_path="_response.json"):
+    full_log = open(log_path, "wb")
+    try:
+        chunks = iter(lambda: resp.read1(READ_CHUNK_SIZE), b'')
+        chunks = log_chunks(chunks, full_log)
+        for event, data in parse_sse_events(chunks):
+            if data == b'[DONE]':
+                break
+            if event == b'error':
+                raise RuntimeError(data.decode('utf-8'))
+            # Events are decoded whole: finish_reason, stop, usage and timings
+            # are needed besides the text, and a token event decodes in a few
+            # microseconds.
+            yield json_loads(data)
+    except (OSError, ValueError, http.client.HTTPException):
+        if cancel is not None and cancel.cancelled:
+            raise GenerationCancelled()
+        raise
+    finally:
+        resp.close()
+        full_log.close()
+
+    if cancel is not None and cancel.cancelled:
+        raise GenerationCancelled()
+
+
+def generate_openai_choices(events):
+    for json_data in events:
+        # Some servers send a final usage chunk without choices.
+        if not json_data.get('choices'):
+            continue
         assert(len(json_data['choices']) == 1)
         choice = json_data["choices"][0]
         yield choice
         if choice.get('finish_reason') in ('stop', 'length'):
+            # Read the rest of the stream, which may hold a usage chunk.
+            for _ in events:
+                pass
             break
 
 
+def record_usage(events, stats):
+    # OpenAI compatible servers send a usage object, llama.cpp sends token
+    # counts and timings with its final event.
+    for json_data in events:
+        usage = json_data.get('usage')
+        timings = json_data.get('timings')
+        if usage:
+            stats['prompt_tokens'] = usage.get('prompt_tokens')
+            stats['completion_tokens'] = usage.get('completion_tokens')
+        elif 'tokens_evaluated' in json_data:
+            stats['prompt_tokens'] = json_data['tokens_evaluated']
+            stats['completion_tokens'] = json_data.get('tokens_predicted')
+        elif timings:
+            stats['prompt_tokens'] = timings.get('cache_n', 0) + timings.get('prompt_n', 0)
+            stats['completion_tokens'] = timings.get('predicted_n')
+        yield json_data
+
+
 def process_and_log_generator(input_generator, tuple_index, filename):
     with open(filename, 'w') as f:
         for item_tuple in input_generator:
@@ -171,6 +648,27 @@ def format_as_roleplay(generator, names):
         yield in_buffer
 
 
+def count_chunks(generator, stats):
+    for text in generator:
+        stats['chunks'] += 1
+        yield text
+
+
+def stop_at_speakers(generator, stop_names, stats):
+    # format_as_roleplay() emits speaker switches as '@name' header lines.
+    names = '|'.join(re.escape(x) for x in stop_names)
+    header_re = re.compile(f'^@({names})\n', flags=re.MULTILINE)
+
+    for text in generator:
+        match = header_re.search(text)
+        if match:
+            if match.start():
+                yield text[:match.start()]
+            stats['early_stop'] = match.group(1)
+            return
+        yield text
+
+
 def clean_whitespace(generator):
     for text in generator:
         # Remove pesky spaces before newlines.
@@ -182,95 +680,288 @@ def clean_whitespace(generator):
         yield text
 
 
-def parse_chathistory(history_text):
+class Roleplay:
+    # A named chathistory message. Parsed content stays a span of the source
+    # text until it is first read.
+    __slots__ = ('name', '_content', '_source', '_start', '_end')
+
+    def __init__(self, name, content):
+        self.name = name
+        self._content = content
+        self._source = None
+
+    @classmethod
+    def from_source(cls, name, source, start, end):
+        roleplay = cls(name, None)
+        roleplay._source = source
+        roleplay._start = start
+        roleplay._end = end
+        return roleplay
+
+    def copy(self):
+        if self._source is None:
+            return Roleplay(self.name, self._content)
+        return Roleplay.from_source(self.name, self._source, self._start, self._end)
+
+    @property
+    def content(self):
+        if self._source is not None:
+            self._content = self._source[self._start:self._end]
+            self._source = None
+        return self._content
+
+    @content.setter
+    def content(self, value):
+        self._content = value
+        self._source = None
+
+
+class Message:
+    __slots__ = ('role', 'content', 'prefix')
+
+    def __init__(self, role, content, prefix=False):
+        self.role = role
+        self.content = content
+        self.prefix = prefix
+
+    def to_dict(self):
+        ret = {'role': self.role, 'content': self.content}
+        if self.prefix:
+            ret['prefix'] = True
+        return ret
+
+
+NAME_HEADER_RE = re.compile(r'^@(.*)', flags=re.MULTILINE)
+
+
+def parse_chathistory(history_text, pos=0):
     history = []
 
-    if not history_text:
+    if pos >= len(history_text):
         return history
 
-    if not history_text.startswith('@'):
-        return [{'name': 'user', 'content': history_text}]
-
-    parts = re.split(r'^@(.*)', history_text, flags=re.MULTILINE)
-    parts.pop(0)
+    if not history_text.startswith('@', pos):
+        return [Roleplay.from_source('user', history_text, pos, len(history_text))]
 
-    for i in range(0, len(parts), 2):
-        message = {'name': parts[i]}
-        message['content'] = parts[i + 1]
-        history.append(message)
+    prev = None
+    for match in NAME_HEADER_RE.finditer(history_text, pos):
+        if prev is not None:
+            history.append(Roleplay.from_source(prev.group(1), history_text, prev.end(), match.start()))
+        prev = match
+    history.append(Roleplay.from_source(prev.group(1), history_text, prev.end(), len(history_text)))
 
     return history
 
 
+def reparse_chathistory(history, history_text, pos, changed_from):
+    # Messages that end before the first changed offset are kept, the rest of
+    # the text is parsed again. Their offsets are the same in the new text, so
+    # they point at it and the old text can be freed.
+    keep = bisect.bisect_left(history, changed_from, key=lambda x: x._end)
+    if keep:
+        pos = history[keep - 1]._end
+    for message in history[:keep]:
+        if message._source is not None:
+            message._source = history_text
+    return history[:keep] + parse_chathistory(history_text, pos)
+
+
 def build_name_map(prompt_roles, user_name):
     ret = { x: x for x in prompt_roles }
     ret[user_name] = 'user'
     return ret
 
 
-def watch_and_do(path):
-    last_modified = os.path.getmtime(path)
+def watch_and_do(*paths):
+    last_modified = {x: os.path.getmtime(x) for x in paths}
 
     while True:
-        current_modified = os.path.getmtime(path)
-        if current_modified != last_modified:
-            yield(path)
-            last_modified = os.path.getmtime(path)
+        for path in paths:
+            current_modified = os.path.getmtime(path)
+            if current_modified != last_modified[path]:
+                yield(path)
+                last_modified[path] = os.path.getmtime(path)
         time.sleep(SLEEP_TIME)
 
 
-def parse_data_and_chathistory(text):
+def front_matter_bounds(text):
     assert(text.startswith('---'))
-    parts = text.split('---\n', 2)
-    assert(len(parts) == 3)
-    data = yaml.safe_load(parts[1])
-    history = parse_chathistory(parts[2])
+    # Find the front matter bounds without copying the history text.
+    data_start = text.index('---\n') + 4
+    data_end = text.index('---\n', data_start)
+    return data_start, data_end
+
+
+def parse_data_and_chathistory(text):
+    data_start, data_end = front_matter_bounds(text)
+    data = yaml.safe_load(text[data_start:data_end])
+    history = parse_chathistory(text, data_end + 4)
     return(data, history)
 
 
+def read_chat_file(path):
+    with MEMORY_PROFILER.stage('read chat'):
+        with open(path, 'r', encoding='utf-8') as f:
+            content = f.read()
+    with MEMORY_PROFILER.stage('parse chat'):
+        config_content, history = parse_data_and_chathistory(content)
+    return content, config_content, history
+
+
+CHAT_CACHE = FileCache(read_chat_file)
+
+
+def read_chat(path):
+    # Parsed chats are shared, callers get copies they are free to modify.
+    content, config_content, history = CHAT_CACHE.get(path)
+    return content, copy.deepcopy(config_content), [x.copy() for x in history]
+
+
+def list_archive_segments(chat_path):
+    return sorted(glob.glob(f'{glob.escape(chat_path)}.archive-*'))
+
+
+def read_archive_segment(segment_path):
+    with open(segment_path, 'rb') as f:
+        data = f.read()
+    if segment_path.endswith('.zst'):
+        assert(zstandard is not None)
+        data = zstandard.ZstdDecompressor().decompress(data)
+    else:
+        data = gzip.decompress(data)
+    return data.decode('utf-8')
+
+
+def load_archived_history(chat_path):
+    history = []
+    for segment_path in list_archive_segments(chat_path):
+        history += parse_chathistory(read_archive_segment(segment_path))
+    return history
+
+
+def merge_archived_names(archived, names):
+    # Speakers of a newly archived span, which comes after everything archived
+    # before it.
+    return {
+        'names': list(dict.fromkeys(archived['names'] + names)),
+        'recent': list(dict.fromkeys(names[::-1] + archived['recent'])),
+    }
+
+
+def read_archived_names(chat_path):
+    # Speakers of the archived messages, in order of first appearance and
+    # most recent first, so archiving doesn't change who is in the chat.
+    names_path = f'{chat_path}.archived-names.json'
+    if os.path.isfile(names_path):
+        with open(names_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    # Archives made before the names were kept.
+    archived = {'names': [], 'recent': []}
+    segment_paths = list_archive_segments(chat_path)
+    for segment_path in segment_paths:
+        names = [x.name for x in parse_chathistory(read_archive_segment(segment_path))]
+        archived = merge_archived_names(archived, names)
+    if segment_paths:
+        write_archived_names(chat_path, archived)
+    return archived
+
+
+def write_archived_names(chat_path, archived):
+    names_path = f'{chat_path}.archived-names.json'
+    with open(f'{names_path}.tmp', 'w', encoding='utf-8') as f:
+        json.dump(archived, f)
+    os.replace(f'{names_path}.tmp', names_path)
+
+
+def leading_system_count(history):
+    count = 0
+    while count < len(history) and history[count].name == 'system':
+        count += 1
+    return count
+
+
+def archive_chat(path, keep, compression):
+    assert(keep >= 0)
+    with open(path, 'r', encoding='utf-8') as f:
+        text = f.read()
+    assert(text.startswith('---'))
+    body_start = text.index('---\n', text.index('---\n') + 4) + 4
+    headers = list(NAME_HEADER_RE.finditer(text, body_start))
+
+    # Leading system messages stay in the active chat.
+    first = 0
+    while first < len(headers) and headers[first].group(1) == 'system':
+        first += 1
+    cut = len(headers) - keep
+    if cut <= first:
+        return
+
+    start = headers[first].start()
+    end = headers[cut].start() if cut < len(headers) else len(text)
+    data = text[start:end].encode('utf-8')
+    if compression == 'zstd' and zstandard is not None:
+        data = zstandard.ZstdCompressor(level=19).compress(data)
+        extension = 'zst'
+    else:
+        data = gzip.compress(data, compresslevel=9)
+        extension = 'gz'
+
+    # Write the segment and its speakers before removing its messages from
+    # the chat.
+    archived = read_archived_names(path)
+    segment_count = len(list_archive_segments(path))
+    segment_path = f'{path}.archive-{segment_count + 1:04d}.{extension}'
+    with open(f'{segment_path}.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(f'{segment_path}.tmp', segment_path)
+    names = [x.group(1) for x in headers[first:cut]]
+    write_archived_names(path, merge_archived_names(archived, names))
+
+    with open(f'{path}.tmp', 'w', encoding='utf-8') as f:
+        f.write(text[:start])
+        f.write(text[end:])
+    os.replace(f'{path}.tmp', path)
+    print(f"Archived {cut - first} messages to {segment_path}.", file=sys.stderr)
+
+
 def combine_repeat_message_roles(messages):
     ret = []
 
-    prev_prompt_role = None
-    for message in messages:
-        role = message['role']
-
-        if role == prev_prompt_role:
-            ret[-1]['content'] += f'\n{message['content']}'
+    for role, group in itertools.groupby(messages, key=lambda x: x.role):
+        group = list(group)
+        if len(group) == 1:
+            ret.append(group[0])
         else:
-            ret.append(message)
-
-        prev_prompt_role = role
+            ret.append(Message(role, '\n'.join(x.content for x in group)))
 
     return ret
 
 
 def prefix_roleplays_with_name(roleplays, exception_names):
     for roleplay in roleplays:
-        name = roleplay['name']
-        content = roleplay['content']
+        name = roleplay.name
+        content = roleplay.content
         if name not in exception_names:
-            roleplay['content'] = f'{name}:'
-            if content:
-                roleplay['content'] += f' {content}'
+            roleplay.content = f'{name}: {content}' if content else f'{name}:'
 
 
 def roleplays_to_messages(roleplays, name_to_role_mapping):
     messages = []
 
     for roleplay in roleplays:
-        role = name_to_role_mapping.get(roleplay['name'], 'assistant')
-        messages.append({'role': role, 'content': roleplay['content']})
+        role = name_to_role_mapping.get(roleplay.name, 'assistant')
+        messages.append(Message(role, roleplay.content))
 
     return messages
 
 
-def guess_next_speaker(history, user_name):
+def guess_next_speaker(history, user_name, archived_names=()):
     if not history:
         return None
 
-    last_speaker = history[-1]['name']
-    last_content = history[-1]['content']
+    last_speaker = history[-1].name
+    last_content = history[-1].content
 
     if last_content.strip('\n') == '':
         return None
@@ -279,8 +970,11 @@ def guess_next_speaker(history, user_name):
         return None
 
     for message in reversed(history):
-        if message['name'] not in PROMPT_ROLES + [user_name, last_speaker]:
-            return message['name']
+        if message.name not in PROMPT_ROLES + [user_name, last_speaker]:
+            return message.name
+    for name in archived_names:
+        if name not in PROMPT_ROLES + [user_name, last_speaker]:
+            return name
 
     if last_speaker != user_name:
         return user_name
@@ -288,16 +982,17 @@ def guess_next_speaker(history, user_name):
     return 'assistant'
 
 
-def get_name_autocomplete(history, extra_names):
+def get_name_autocomplete(history, extra_names, archived_names=()):
     if not history:
         return None
 
     # Autocomplete only works if the last message is empty. No newline.
-    if history[-1]['content'] != "":
+    if history[-1].content != "":
         return None
 
-    name_candidates = [x['name'] for x in reversed(history)]
+    name_candidates = [x.name for x in reversed(history)]
     latest_speaker = name_candidates.pop(0)
+    name_candidates += archived_names
 
     # First, see if we have an exact name match in our history.
     for candidate in name_candidates:
@@ -361,21 +1056,29 @@ def resolve_local_path(base_dir, path):
     return os.path.join(base_dir, path)
 
 
-def extract_ai_card_data(png_path):
-    png_file = open(png_path, "rb")
-    img = PIL.Image.open(png_file)
-    img.load()
+def decode_ai_card_data(png_path):
+    with MEMORY_PROFILER.stage('decode card'):
+        png_file = open(png_path, "rb")
+        img = PIL.Image.open(png_file)
+        img.load()
 
-    if "ccv3" in img.info:
-        chara = img.info["ccv3"]
-    else:
-        chara = img.info["chara"]
+        if "ccv3" in img.info:
+            chara = img.info["ccv3"]
+        else:
+            chara = img.info["chara"]
 
-    decoded_data = base64.b64decode(chara).decode("utf-8")
-    data = json.loads(decoded_data)
+        decoded_data = base64.b64decode(chara).decode("utf-8")
+        data = json.loads(decoded_data)
     return data['data']
 
 
+CARD_CACHE = FileCache(decode_ai_card_data)
+
+
+def extract_ai_card_data(png_path):
+    return CARD_CACHE.get(png_path)
+
+
 def render_template(base_dir, template, user, charcard_template_str, chars):
     def replace_insert_txt(match):
         path = match.group(1).strip()
@@ -452,35 +1155,505 @@ def render_template(base_dir, template, user, charcard_template_str, chars):
 
 
 def messages_to_chathistory(messages):
-    ret = ''
-    for message in messages:
-        ret += f'@{message['role']}\n{message['content']}\n\n'
-    return ret
+    return ''.join(f'@{x.role}\n{x.content}\n\n' for x in messages)
+
+
+class IncrementalRenderError(Exception):
+    pass
+
+
+class IncrementalChatTemplate:
+    # Renders a chat template one message at a time and keeps the rendered
+    # conversation, so each turn only renders the messages that changed. This
+    # relies on a message's output not depending on the messages after it,
+    # which is checked against a full render the first time and every
+    # INCREMENTAL_VERIFY_INTERVAL renders after that.
+    def __init__(self, chat_template_str, vars):
+        self.template = jinja2.Template(chat_template_str)
+        self.vars = vars
+        self.lock = threading.Lock()
+        self.incremental = None
+        self.renders = 0
+        self.keys = []
+        self.segments = []
+        self.prefix = ''
+
+    def render_full(self, messages, add_generation_prompt):
+        return self.template.render(
+            messages=messages,
+            add_generation_prompt=add_generation_prompt,
+            **self.vars,
+        )
 
+    def render_tail(self, window, add_generation_prompt=False):
+        # The output added by the last message of the window, or by the
+        # generation prompt.
+        if add_generation_prompt:
+            head = self.render_full(window, False)
+            full = self.render_full(window, True)
+        else:
+            head = self.render_full(window[:-1], False)
+            full = self.render_full(window, False)
+        if not full.startswith(head):
+            raise IncrementalRenderError()
+        return full[len(head):]
+
+    def segment_window(self, messages, i):
+        # Message i rendered after the first message (or two, to keep the
+        # index parity that alternation checks look at) and its predecessor.
+        if i < 3:
+            return messages[:i + 1]
+        anchor = messages[:1] if i % 2 == 0 else messages[:2]
+        return anchor + messages[i - 1:i + 1]
+
+    def render_incremental(self, messages, add_generation_prompt):
+        keys = [(x['role'], x['content']) for x in messages]
+
+        unchanged = 0
+        for old, new in zip(self.keys, keys):
+            if old != new:
+                break
+            unchanged += 1
+
+        if unchanged < len(self.segments):
+            self.segments = self.segments[:unchanged]
+            self.prefix = ''.join(self.segments)
+
+        new_segments = []
+        for i in range(unchanged, len(messages)):
+            if i == 0:
+                new_segments.append(self.render_full(messages[:1], False))
+            else:
+                new_segments.append(self.render_tail(self.segment_window(messages, i)))
+        self.segments += new_segments
+        self.prefix += ''.join(new_segments)
+        self.keys = keys
+
+        if not add_generation_prompt:
+            return self.prefix
+        window = self.segment_window(messages, len(messages) - 1)
+        return self.prefix + self.render_tail(window, True)
+
+    def render(self, messages, add_generation_prompt=True):
+        if self.incremental is False or not messages:
+            return self.render_full(messages, add_generation_prompt)
+
+        with self.lock:
+            try:
+                prompt = self.render_incremental(messages, add_generation_prompt)
+            except IncrementalRenderError:
+                prompt = None
+
+            self.renders += 1
+            verify = self.incremental is None or self.renders % INCREMENTAL_VERIFY_INTERVAL == 0
+            if prompt is not None and not verify:
+                return prompt
+
+            full = self.render_full(messages, add_generation_prompt)
+            self.incremental = prompt == full
+            if not self.incremental:
+                print("chat_template can't be rendered incrementally, using full renders.", file=sys.stderr)
+                self.keys = []
+                self.segments = []
+                self.prefix = ''
+            return full
+
+
+INCREMENTAL_CHAT_TEMPLATES = collections.OrderedDict()
+INCREMENTAL_CHAT_TEMPLATES_LOCK = threading.Lock()
+
+
+def get_incremental_chat_template(chat_template_str, vars, chat_key=None):
+    # Each chat keeps its own rendered conversation, only the most recently
+    # used ones are kept.
+    key = (chat_key, chat_template_str, json.dumps(vars, sort_keys=True, default=str))
+    with INCREMENTAL_CHAT_TEMPLATES_LOCK:
+        template = INCREMENTAL_CHAT_TEMPLATES.get(key)
+        if template is None:
+            template = IncrementalChatTemplate(chat_template_str, vars)
+            INCREMENTAL_CHAT_TEMPLATES[key] = template
+            if len(INCREMENTAL_CHAT_TEMPLATES) > INCREMENTAL_CACHE_SIZE:
+                INCREMENTAL_CHAT_TEMPLATES.popitem(last=False)
+        else:
+            INCREMENTAL_CHAT_TEMPLATES.move_to_end(key)
+    return template
 
-def render_chat_template(chat_template_str, messages, vars):
-    template = jinja2.Template(chat_template_str)
+
+def render_chat_template(chat_template_str, messages, vars, incremental=False, chat_key=None):
+    messages = [x.to_dict() for x in messages]
 
     completion_message = ''
     if messages[-1]['role'] == 'assistant':
         last_message = messages.pop(-1)
         completion_message = last_message['content']
 
-    raw_prompt = template.render(
+    if incremental:
+        template = get_incremental_chat_template(chat_template_str, vars, chat_key)
+        raw_prompt = template.render(messages)
+    else:
+        template = jinja2.Template(chat_template_str)
+        raw_prompt = template.render(
+            messages=messages,
+            add_generation_prompt=True,
+            **vars,
+        )
+    raw_prompt += completion_message
+    return raw_prompt
+
+
+def request_completion(config, messages):
+    data = config['api_call_props'].copy()
+    data['stream'] = False
+    api_mode = config['api_mode']
+
+    if api_mode == 'openai-chat':
+        data['messages'] = [x.to_dict() for x in messages]
+    else:
+        vars = config.get('chat_template_vars', {})
+        data['prompt'] = render_chat_template(config['chat_template'], messages, vars)
+
+    req = urllib.request.Request(
+        config['api_url'],
+        headers=config['api_call_headers'],
+        method="POST",
+        data=json.dumps(data).encode('utf-8'),
+    )
+    with urllib.request.urlopen(req) as resp:
+        json_data = json.load(resp)
+
+    if api_mode == 'openai-chat':
+        return json_data['choices'][0]['message']['content']
+    if api_mode == 'openai-completion':
+        return json_data['choices'][0]['text']
+    return json_data['content']
+
+
+def roleplays_to_transcript(roleplays):
+    return '\n\n'.join(f'{x.name}: {x.content}' for x in roleplays)
+
+
+def summarize_roleplays(config, previous_summary, roleplays):
+    transcript = roleplays_to_transcript(roleplays)
+    if previous_summary:
+        transcript = f'SUMMARY SO FAR:\n{previous_summary}\n\nCONTINUATION:\n{transcript}'
+
+    messages = [
+        Message('system', config['summary_prompt']),
+        Message('user', transcript),
+    ]
+    return request_completion(config, messages).strip()
+
+
+SUMMARY_CACHE_LOCK = threading.Lock()
+
+
+def read_summary_cache(cache_path):
+    if not os.path.isfile(cache_path):
+        return {}
+    with open(cache_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def store_summary(cache_path, key, summary):
+    # Every chat in the directory shares the cache file, merge with what
+    # others wrote in the meantime and replace the file in one step.
+    with SUMMARY_CACHE_LOCK:
+        cache = read_summary_cache(cache_path)
+        cache[key] = summary
+        tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(cache, f, indent=2)
+        os.replace(tmp_path, cache_path)
+
+
+def compact_history(config, history, template_directory):
+    horizon = config['summarize_horizon']
+    if horizon is None:
+        return history
+
+    # The horizon has to keep at least the message being generated.
+    if horizon < 1:
+        raise ValueError(f"summarize_horizon must be at least 1, got {horizon}")
+    if config['summarize_chunk'] < 1:
+        raise ValueError(f"summarize_chunk must be at least 1, got {config['summarize_chunk']}")
+
+    start = leading_system_count(history)
+    body = history[start:]
+
+    # Summarize whole chunks only, so the summarized span and its cache key
+    # change once every summarize_chunk messages instead of every turn.
+    chunk = config['summarize_chunk']
+    span_len = (len(body) - horizon) // chunk * chunk
+    if span_len <= 0:
+        return history
+
+    cache_path = resolve_local_path(template_directory, config['summary_cache_file'])
+    with SUMMARY_CACHE_LOCK:
+        cache = read_summary_cache(cache_path)
+
+    # Each chunk's summary builds on the summary of everything before it and
+    # is keyed by the hash of the whole span it covers.
+    summary = None
+    span_hash = hashlib.sha256()
+    for i in range(0, span_len, chunk):
+        block = body[i:i + chunk]
+        for x in block:
+            span_hash.update(f'@{x.name}\n{x.content}\n'.encode('utf-8'))
+        key = span_hash.hexdigest()
+
+        if key not in cache:
+            print("Summarizing history ...", file=sys.stderr)
+            cache[key] = summarize_roleplays(config, summary, block)
+            store_summary(cache_path, key, cache[key])
+        summary = cache[key]
+
+    summary_message = Roleplay(
+        'system',
+        f'[SUMMARY OF EARLIER EVENTS]\n{summary}\n[/SUMMARY OF EARLIER EVENTS]',
+    )
+    return history[:start] + [summary_message] + body[span_len:]
+
+
+def retrieval_terms(text):
+    mask = (1 << RETRIEVAL_HASH_BITS) - 1
+    return [zlib.crc32(x.encode('utf-8')) & mask for x in RETRIEVAL_TOKEN_RE.findall(text.lower())]
+
+
+def retrieval_doc_hash(text):
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def save_npz(path, **arrays):
+    with open(f'{path}.tmp', 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(f'{path}.tmp', path)
+
+
+class RetrievalIndex:
+    # BM25 over hashed terms. Postings are flat (term, doc, tf) arrays: a main
+    # segment sorted by term for binary search, plus an unsorted tail holding
+    # recently appended messages that is merged into the main segment once it
+    # grows. Both are saved to their own file, so a turn usually only rewrites
+    # the small tail.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.texts = None
+        self.doc_hashes = np.zeros(0, np.uint64)
+        self.doc_lens = np.zeros(0, np.float32)
+        self.terms = np.zeros(0, np.int32)
+        self.docs = np.zeros(0, np.int32)
+        self.tfs = np.zeros(0, np.float32)
+        self.main_doc_count = 0
+        self.main_changed = True
+        self.tail_terms = np.zeros(0, np.int32)
+        self.tail_docs = np.zeros(0, np.int32)
+        self.tail_tfs = np.zeros(0, np.float32)
+
+    @classmethod
+    def load(cls, path):
+        index = cls()
+        with np.load(path) as data:
+            index.terms, index.docs, index.tfs = data['terms'], data['docs'], data['tfs']
+            index.doc_hashes, index.doc_lens = data['doc_hashes'], data['doc_lens']
+        index.main_doc_count = len(index.doc_hashes)
+        index.main_changed = False
+
+        # A tail saved against an older main segment is dropped, its
+        # messages are indexed again on the next update.
+        tail_path = f'{path}.tail.npz'
+        if os.path.isfile(tail_path):
+            with np.load(tail_path) as data:
+                if int(data['base']) == index.main_doc_count:
+                    index.tail_terms, index.tail_docs, index.tail_tfs = data['terms'], data['docs'], data['tfs']
+                    index.doc_hashes = np.concatenate([index.doc_hashes, data['doc_hashes']])
+                    index.doc_lens = np.concatenate([index.doc_lens, data['doc_lens']])
+        return index
+
+    def save(self, path):
+        main = self.main_doc_count
+        if self.main_changed:
+            save_npz(path, terms=self.terms, docs=self.docs, tfs=self.tfs,
+                     doc_hashes=self.doc_hashes[:main], doc_lens=self.doc_lens[:main])
+            self.main_changed = False
+        save_npz(f'{path}.tail.npz', base=np.array(main), terms=self.tail_terms, docs=self.tail_docs,
+                 tfs=self.tail_tfs, doc_hashes=self.doc_hashes[main:], doc_lens=self.doc_lens[main:])
+
+    def truncate(self, doc_count):
+        if doc_count >= len(self.doc_hashes):
+            return
+        if doc_count < self.main_doc_count:
+            self.main_doc_count = doc_count
+            self.main_changed = True
+        keep = self.docs < doc_count
+        self.terms, self.docs, self.tfs = self.terms[keep], self.docs[keep], self.tfs[keep]
+        keep = self.tail_docs < doc_count
+        self.tail_terms, self.tail_docs, self.tail_tfs = self.tail_terms[keep], self.tail_docs[keep], self.tail_tfs[keep]
+        self.doc_hashes = self.doc_hashes[:doc_count]
+        self.doc_lens = self.doc_lens[:doc_count]
+
+    def unchanged_count(self, texts):
+        # Compare with the texts of the last update, the hashes are only
+        # needed right after loading.
+        common = min(len(texts), len(self.doc_hashes))
+        if self.texts is not None:
+            common = min(common, len(self.texts))
+            if self.texts[:common] == texts[:common]:
+                return common
+            for i, (old, new) in enumerate(zip(self.texts, texts[:common])):
+                if old != new:
+                    return i
+
+        hashes = np.array([retrieval_doc_hash(x) for x in texts[:common]], np.uint64)
+        mismatch = np.flatnonzero(hashes != self.doc_hashes[:common])
+        return int(mismatch[0]) if len(mismatch) else common
+
+    def update(self, texts):
+        # Keep the indexed messages that are unchanged, then append the rest.
+        unchanged = self.unchanged_count(texts)
+        self.texts = texts
+        if unchanged == len(texts) == len(self.doc_hashes):
+            return False
+
+        self.truncate(unchanged)
+        hashes = np.array([retrieval_doc_hash(x) for x in texts[unchanged:]], np.uint64)
+
+        new_terms = [self.tail_terms]
+        new_docs = [self.tail_docs]
+        new_tfs = [self.tail_tfs]
+        doc_lens = []
+        for doc_id in range(unchanged, len(texts)):
+            terms = retrieval_terms(texts[doc_id])
+            doc_lens.append(len(terms))
+            terms, tfs = np.unique(np.array(terms, np.int32), return_counts=True)
+            new_terms.append(terms)
+            new_docs.append(np.full(len(terms), doc_id, np.int32))
+            new_tfs.append(tfs.astype(np.float32))
+
+        self.tail_terms = np.concatenate(new_terms)
+        self.tail_docs = np.concatenate(new_docs)
+        self.tail_tfs = np.concatenate(new_tfs)
+        self.doc_hashes = np.concatenate([self.doc_hashes, hashes])
+        self.doc_lens = np.concatenate([self.doc_lens, np.array(doc_lens, np.float32)])
+
+        if len(self.tail_terms) > max(RETRIEVAL_MERGE_SIZE, len(self.terms) // 4):
+            terms = np.concatenate([self.terms, self.tail_terms])
+            order = np.argsort(terms, kind='stable')
+            self.terms = terms[order]
+            self.docs = np.concatenate([self.docs, self.tail_docs])[order]
+            self.tfs = np.concatenate([self.tfs, self.tail_tfs])[order]
+            self.tail_terms = self.tail_terms[:0]
+            self.tail_docs = self.tail_docs[:0]
+            self.tail_tfs = self.tail_tfs[:0]
+            self.main_doc_count = len(self.doc_hashes)
+            self.main_changed = True
+        return True
+
+    def search(self, text, top_k):
+        doc_count = len(self.doc_lens)
+        if not doc_count:
+            return []
+
+        scores = np.zeros(doc_count, np.float32)
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_lens / max(self.doc_lens.mean(), 1))
+        query = np.unique(np.array(retrieval_terms(text), np.int32))
+        starts = np.searchsorted(self.terms, query, 'left')
+        ends = np.searchsorted(self.terms, query, 'right')
+        in_tail = np.isin(self.tail_terms, query)
+        tail_terms = self.tail_terms[in_tail]
+        tail_docs = self.tail_docs[in_tail]
+        tail_tfs = self.tail_tfs[in_tail]
+
+        for term, start, end in zip(query, starts, ends):
+            in_term = tail_terms == term
+            docs = np.concatenate([self.docs[start:end], tail_docs[in_term]])
+            if not len(docs):
+                continue
+            tfs = np.concatenate([self.tfs[start:end], tail_tfs[in_term]])
+            idf = math.log(1 + (doc_count - len(docs) + 0.5) / (len(docs) + 0.5))
+            scores[docs] += idf * tfs * (BM25_K1 + 1) / (tfs + norm[docs])
+
+        top_k = min(top_k, doc_count)
+        best = np.argpartition(-scores, top_k - 1)[:top_k]
+        best = best[np.argsort(-scores[best])]
+        return [int(x) for x in best if scores[x] > 0]
+
+
+RETRIEVAL_INDEX_CACHE = FileCache(RetrievalIndex.load)
+
+
+def retrieve_past_messages(config, history, chat_path):
+    assert(np is not None)
+    horizon = config['retrieval_horizon']
+    past = [x for x in history[:-horizon] if x.name != 'system']
+    recent = [x for x in history[-horizon:] if x.content.strip()]
+    recent = recent[-config['retrieval_query_messages']:]
+    if not past or not recent:
+        return []
+
+    # The index stays loaded between turns.
+    index_path = None
+    index = None
+    if chat_path is not None:
+        index_path = f'{chat_path}.index.npz'
+        if os.path.isfile(index_path):
+            index = RETRIEVAL_INDEX_CACHE.get(index_path)
+    if index is None:
+        index = RetrievalIndex()
+
+    texts = [f'{x.name}: {x.content.strip()}' for x in past]
+    query = '\n'.join(x.content for x in recent)
+    with index.lock:
+        if index.update(texts) and index_path is not None:
+            index.save(index_path)
+            RETRIEVAL_INDEX_CACHE.put(index_path, index)
+        doc_ids = index.search(query, config['retrieval_top_k'])
+
+    budget = config['retrieval_token_budget'] * CHARS_PER_TOKEN
+    selected = []
+    for doc_id in doc_ids:
+        if len(texts[doc_id]) > budget:
+            continue
+        budget -= len(texts[doc_id])
+        selected.append(doc_id)
+
+    return [texts[x] for x in sorted(selected)]
+
+
+def render_prompt_prefix(chat_template_str, messages, vars, incremental=False, chat_key=None):
+    messages = [x.to_dict() for x in messages]
+
+    if incremental:
+        template = get_incremental_chat_template(chat_template_str, vars, chat_key)
+        return template.render(messages, add_generation_prompt=False)
+
+    template = jinja2.Template(chat_template_str)
+    return template.render(
         messages=messages,
-        add_generation_prompt=True,
+        add_generation_prompt=False,
         **vars,
     )
-    raw_prompt += completion_message
-    return raw_prompt
 
 
-def generate(io_out, working_directory, config_content, history, template_directory):
+def debug_path(config, filename):
+    if not config['write_debug_files']:
+        return os.devnull
+    return filename
+
+
+def read_config_file(path):
+    with open(path) as f:
+        return yaml.safe_load(f)
+
+
+CONFIG_CACHE = FileCache(read_config_file)
+
+
+def load_config(working_directory, config_content):
     # Merge default config, user config, and .chathistory config .
+    config_file = {}
     config_file_path = find_dot_config_file(working_directory, '.chathistory')
     if config_file_path:
-        with open(config_file_path) as f:
-            config_file = yaml.safe_load(f)
+        config_file = CONFIG_CACHE.get(config_file_path)
 
     config_tmp = config_file.copy()
     config_tmp.update(config_content)
@@ -492,53 +1665,67 @@ def generate(io_out, working_directory, config_content, history, template_direct
     config.update(config_file)
     config.update(config_profile)
     config.update(config_content)
+    return config
 
-    with open("_processed_config.yaml", "w") as f:
-        yaml.dump(config, f)
-
-    if not config['active']:
-        return
 
+def pad_history(config, history, chat_path=None):
     user = config['user']
     out_buf = ''
 
+    # Speakers who only appear in archived messages, most recent first.
+    archived_names = []
+    if chat_path is not None:
+        archived_names = read_archived_names(chat_path)['recent']
+
     # Append name autocomplete, newlines, and optionally a next speaker
-    name_autocomplete = get_name_autocomplete(history, [user] + PROMPT_ROLES)
+    name_autocomplete = get_name_autocomplete(history, [user] + PROMPT_ROLES, archived_names)
     if name_autocomplete:
-        history[-1]['name'] += name_autocomplete
+        history[-1].name += name_autocomplete
         out_buf += name_autocomplete
 
     if config['add_final_message_padding'] and history:
-        final_padding = get_final_message_padding(history[-1]['content'])
+        final_padding = get_final_message_padding(history[-1].content)
         if final_padding:
-            history[-1]['content'] += final_padding
+            history[-1].content += final_padding
             out_buf += final_padding
 
-    next_speaker = guess_next_speaker(history, user)
+    next_speaker = guess_next_speaker(history, user, archived_names)
     if config['guess_next_speaker'] and next_speaker:
-        history.append({'name': next_speaker, 'content': '\n'})
+        history.append(Roleplay(next_speaker, '\n'))
         out_buf += f'@{next_speaker}\n'
 
-    if out_buf:
-        io_out.write(out_buf)
-        io_out.flush()
+    return out_buf
+
+
+def build_messages(config, history, template_directory, chat_path=None):
+    user = config['user']
+
+    # Archived messages are only loaded for features that need deep history.
+    needs_deep_history = config['summarize_horizon'] is not None or config['retrieval_top_k']
+    if chat_path is not None and needs_deep_history:
+        start = leading_system_count(history)
+        history[start:start] = load_archived_history(chat_path)
 
     # Auto-add system prompt if there is one in the current directory
-    if 'system_prompt_file' in config and history[0]['name'] != 'system':
+    if 'system_prompt_file' in config and history[0].name != 'system':
         sys_prompt_path = resolve_local_path(template_directory, config['system_prompt_file'])
         if os.path.isfile(sys_prompt_path):
             with open(sys_prompt_path, 'r') as f:
-                message = {'name': 'system', 'content': f.read()}
+                message = Roleplay('system', f.read())
                 history.insert(0, message)
 
-    # Render chathistory templates.
-    chars = [x['name'] for x in history]
+    # Render chathistory templates. Characters who only appear in archived
+    # messages are still in the chat.
+    chars = [x.name for x in history]
+    if chat_path is not None:
+        chars = read_archived_names(chat_path)['names'] + chars
     chars = list(dict.fromkeys(chars))
     chars = [x for x in chars if x not in PROMPT_ROLES]
     charcard_template = config['charcard_template']
-    for x in history:
-        x['content'] = render_template(template_directory, x['content'], user, charcard_template, chars)
-        x['content'] = x['content'].strip('\n')
+    with MEMORY_PROFILER.stage('render templates'):
+        for x in history:
+            content = render_template(template_directory, x.content, user, charcard_template, chars)
+            x.content = content.strip('\n')
 
     # Add character book entry
     if config['character_book_png']:
@@ -546,7 +1733,7 @@ def generate(io_out, working_directory, config_content, history, template_direct
         resolved_path = resolve_local_path(candidate_path)
         ai_card_data = extract_ai_card_data(resolved_path)
         last_message = history[-2]
-        last_message_content_norm = last_message['content'].lower()
+        last_message_content_norm = last_message.content.lower()
         for entry in ai_card_data['character_book']['entries']:
             entry_keyword_found = False
             for key in entry['keys']:
@@ -554,7 +1741,18 @@ def generate(io_out, working_directory, config_content, history, template_direct
                     entry_keyword_found = True
                     break
             if entry_keyword_found:
-                last_message['content'] += f"\n\n[LOREBOOK ENTRY]\n{entry['content']}\n[/LOREBOOK ENTRY]"
+                last_message.content += f"\n\n[LOREBOOK ENTRY]\n{entry['content']}\n[/LOREBOOK ENTRY]"
+
+    # Add relevant messages from beyond the retrieval horizon if configured.
+    if config['retrieval_top_k'] and len(history) >= 2:
+        passages = retrieve_past_messages(config, history, chat_path)
+        if passages:
+            passages = '\n\n'.join(passages)
+            history[-2].content += f"\n\n[RELEVANT PAST EVENTS]\n{passages}\n[/RELEVANT PAST EVENTS]"
+
+    # Replace history beyond the horizon with a cached summary if configured.
+    with MEMORY_PROFILER.stage('compact history'):
+        history = compact_history(config, history, template_directory)
 
     # Add "character_name:" prefixes to messages if configured.
     if config['prefix_messages_with_name']:
@@ -562,11 +1760,12 @@ def generate(io_out, working_directory, config_content, history, template_direct
 
     # Format for OpenAI compatible chat completions API
     name_to_prompt_role = build_name_map(PROMPT_ROLES, user)
-    messages = roleplays_to_messages(history, name_to_prompt_role)
+    with MEMORY_PROFILER.stage('to messages'):
+        messages = roleplays_to_messages(history, name_to_prompt_role)
 
     # If the last message is a user message, switch it to assistant
-    if config['prefix_messages_with_name'] and messages[-1]['role'] == 'user':
-        messages[-1]['role'] = 'assistant'
+    if config['prefix_messages_with_name'] and messages[-1].role == 'user':
+        messages[-1].role = 'assistant'
 
     # Make sure we alternate between user and assistant if configured.
     if config['enforce_nonrepeating_roles']:
@@ -574,82 +1773,191 @@ def generate(io_out, working_directory, config_content, history, template_direct
 
     # If the last message is an empty assistant message, remove it. This never
     # happens if the prefix_messages_with_name config option is true.
-    if messages[-1]['role'] == 'assistant' and not messages[-1]['content']:
+    if messages[-1].role == 'assistant' and not messages[-1].content:
         messages.pop(-1)
 
     # DeepSeek Chat Prefix Completion, continuation property on the last message.
-    if messages[-1]['role'] == 'assistant':
-        messages[-1]['prefix'] = True
+    if messages[-1].role == 'assistant':
+        messages[-1].prefix = True
+
+    return messages
+
+
+def is_generation_due(history):
+    if not history:
+        return False
+
+    # A final message with content but no trailing newline is still being
+    # typed.
+    return get_final_message_padding(history[-1].content) != '\n\n'
+
+
+def prewarm(config, history, template_directory, chat_path=None, cancel=None):
+    if not config['active']:
+        return
+
+    api_url = config['prewarm_api_url']
+    if api_url is None:
+        if config['api_mode'] != 'llamacpp-completion':
+            print("Pre-warming needs prewarm_api_url outside of llamacpp-completion mode, skipping.", file=sys.stderr)
+            return
+        api_url = config['api_url']
+
+    # Lorebook and retrieval entries go into the message before the one the
+    # next turn generates. That is the message being edited here, so they are
+    # left out to keep the prefix the same as the real prompt.
+    config = config.copy()
+    config['character_book_png'] = None
+    config['retrieval_top_k'] = None
+
+    # The message being edited is unstable, only send what comes before it.
+    messages = build_messages(config, history, template_directory, chat_path)
+    messages.pop(-1)
+    if not messages:
+        return
+
+    print("Pre-warming prompt cache ...", file=sys.stderr)
+    data = config['api_call_props'].copy()
+    vars = config.get('chat_template_vars', {})
+    data['prompt'] = render_prompt_prefix(config['chat_template'], messages, vars, config['incremental_chat_template'], chat_path)
+    data['n_predict'] = 0
+    data['cache_prompt'] = True
+    data['stream'] = False
+
+    conn = open_api_connection(api_url)
+    try:
+        resp = send_api_request(conn, api_url, config['api_call_headers'], json.dumps(data).encode('utf-8'), cancel)
+        resp.read()
+    except (OSError, http.client.HTTPException):
+        if cancel is not None and cancel.cancelled:
+            raise GenerationCancelled()
+        raise
+    finally:
+        conn.close()
+
+    # A shut down connection can also look like the end of the response.
+    if cancel is not None and cancel.cancelled:
+        raise GenerationCancelled()
+    print("pre-warm finished.", file=sys.stderr)
+
+
+def generate(io_out, working_directory, config_content, history, template_directory, cancel=None, chat_path=None):
+    with MEMORY_PROFILER.stage('load config'):
+        config = load_config(working_directory, config_content)
+
+    with open(debug_path(config, "_processed_config.yaml"), "w") as f:
+        yaml.dump(config, f)
+
+    if not config['active']:
+        return
+
+    # Connect to the backend while the prompt is being prepared.
+    connection = preconnect(config['api_url'])
+
+    user = config['user']
+
+    # The preconnected connection is closed if preparing the request fails.
+    try:
+        with MEMORY_PROFILER.stage('pad history'):
+            out_buf = pad_history(config, history, chat_path)
+        if out_buf:
+            io_out.write(out_buf)
+            io_out.flush()
+
+        with MEMORY_PROFILER.stage('build messages'):
+            messages = build_messages(config, history, template_directory, chat_path)
+
+        print("Sending request ...", file=sys.stderr)
+        data = config['api_call_props'].copy()
+        api_mode = config['api_mode']
+        stats = {
+            'ttft': None, 'chunks': 0, 'early_stop': None, 'tokens_saved': None,
+            'prompt_tokens': None, 'completion_tokens': None,
+        }
+        request_start = time.monotonic()
+
+        with MEMORY_PROFILER.stage('serialize request'):
+            if api_mode == 'openai-chat':
+                data['messages'] = [x.to_dict() for x in messages]
+            elif api_mode in ('openai-completion', 'llamacpp-completion'):
+                vars = config.get('chat_template_vars', {})
+                data['prompt'] = render_chat_template(config['chat_template'], messages, vars, config['incremental_chat_template'], chat_path)
+            # OpenAI compatible servers only report usage of a stream when
+            # asked to.
+            if config['usage_ledger_file'] and api_mode != 'llamacpp-completion' and data.get('stream'):
+                data.setdefault('stream_options', {'include_usage': True})
+            data_serialized = json.dumps(data).encode('utf-8')
+
+        conn, resp = send_preconnected_request(connection, config['api_url'], config['api_call_headers'], data_serialized, cancel)
+    except BaseException:
+        discard_preconnection(connection)
+        raise
+
+    events = generate_api_data_lines(resp, cancel, debug_path(config, "_response.json"))
+    events = record_usage(events, stats)
 
     # For debug purposes, write the OpenAI message array back into chathistory
-    # format.
-    with open("_processed_chathistory.txt", "w") as f:
+    # format. Debug files are only written once the request is on its way.
+    with open(debug_path(config, "_processed_chathistory.txt"), "w") as f:
         f.write(messages_to_chathistory(messages))
 
-    print("Sending request ...", file=sys.stderr)
-    data = config['api_call_props']
-    api_mode = config['api_mode']
-
     if api_mode == 'openai-chat':
-        data['messages'] = messages
-        with open("_request.json", "w", encoding="utf-8") as f:
+        with open(debug_path(config, "_request.json"), "w", encoding="utf-8") as f:
             json.dump(data, f, indent=2)
+    else:
+        with open(debug_path(config, "_request.json"), "wb") as f:
+            f.write(data_serialized)
 
-        req = urllib.request.Request(
-            config['api_url'],
-            data=json.dumps(data).encode('utf-8'),
-            headers=config['api_call_headers'],
-            method="POST"
-        )
-        choices = generate_openai_choices(req)
+    if api_mode == 'openai-chat':
+        choices = generate_openai_choices(events)
         llm_gen = ((x['delta']['content'], x['delta'].get('reasoning_content')) for x in choices if 'content' in x['delta'])
 
     elif api_mode == 'openai-completion':
-        vars = config.get('chat_template_vars', {})
-        data['prompt'] = render_chat_template(config['chat_template'], messages, vars)
-        data_serialized = json.dumps(data).encode('utf-8')
-
-        with open("_request.json", "wb") as f:
-            f.write(data_serialized)
-
-        req = urllib.request.Request(
-            config['api_url'],
-            headers=config['api_call_headers'],
-            method="POST",
-            data=data_serialized,
-        )
-        llm_gen = ((x['text'], None) for x in generate_openai_choices(req))
+        llm_gen = ((x['text'], None) for x in generate_openai_choices(events))
 
     elif api_mode == 'llamacpp-completion':
-        vars = config.get('chat_template_vars', {})
-        data['prompt'] = render_chat_template(config['chat_template'], messages, vars)
-        data_serialized = json.dumps(data).encode('utf-8')
+        llm_gen = ((x['content'], None) for x in events)
 
-        with open("_request.json", "wb") as f:
-            f.write(data_serialized)
-
-        req = urllib.request.Request(
-            config['api_url'],
-            headers=config['api_call_headers'],
-            method="POST",
-            data=data_serialized,
-        )
-        llm_gen = ((x['content'], None) for x in generate_api_data_lines(req))
-
-    llm_gen = process_and_log_generator(llm_gen, 0, '_response.txt')
-    llm_gen = process_and_log_generator(llm_gen, 1, '_thinking.txt')
+    llm_gen = process_and_log_generator(llm_gen, 0, debug_path(config, '_response.txt'))
+    llm_gen = process_and_log_generator(llm_gen, 1, debug_path(config, '_thinking.txt'))
     llm_gen = (x[0] for x in llm_gen)
     llm_gen = (x for x in llm_gen if x is not None)
-    names = set(x['name'] for x in history)
+    llm_gen = count_chunks(llm_gen, stats)
+
+    # Stop as soon as the model starts speaking for the user if configured.
+    stop_names = set(config['early_stop_names'])
+    if config['early_stop_on_user']:
+        stop_names.add(user)
+
+    names = set(x.name for x in history) | stop_names
+    if chat_path is not None:
+        names |= set(read_archived_names(chat_path)['names'])
     llm_gen = format_as_roleplay(llm_gen, names)
+    if stop_names:
+        llm_gen = stop_at_speakers(llm_gen, stop_names, stats)
+
     llm_gen = buffer_whitespace(llm_gen)
     llm_gen = clean_whitespace(llm_gen)
 
     ends_with_newline = False
-    for text in llm_gen:
-        ends_with_newline = text.endswith('\n')
-        io_out.write(text)
-        io_out.flush()
+    with MEMORY_PROFILER.stage('stream'):
+        try:
+            for text in llm_gen:
+                if stats['ttft'] is None:
+                    stats['ttft'] = time.monotonic() - request_start
+                ends_with_newline = text.endswith('\n')
+                io_out.write(text)
+                io_out.flush()
+        finally:
+            # Drop the connection right away when stopping early, so the
+            # server stops generating.
+            if stats['early_stop']:
+                abort_connection(resp)
+            llm_gen.close()
+            conn.close()
+
+    if stats['early_stop']:
+        report_early_stop(stats, data)
 
     if config['postfix_output_with_user']:
         user_postfix = f'\n@{user}\n'
@@ -657,17 +1965,573 @@ def generate(io_out, working_directory, config_content, history, template_direct
             user_postfix = '\n' + user_postfix
         io_out.write(user_postfix)
 
+    stats['duration'] = time.monotonic() - request_start
+    append_usage(config, chat_path, stats)
     print("request finished.", file=sys.stderr)
+    return stats
+
 
+def append_usage(config, chat_path, stats):
+    if not config['usage_ledger_file']:
+        return
+
+    record = {
+        'time': time.time(),
+        'chat': os.path.abspath(chat_path) if chat_path else None,
+        'profile': config.get('profile'),
+        'endpoint': config['api_url'],
+    }
+    record.update(stats)
+    with open(os.path.expanduser(config['usage_ledger_file']), 'a', encoding='utf-8') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+def summarize_usage(ledger_path, by):
+    groups = {}
+    with open(os.path.expanduser(ledger_path), 'r', encoding='utf-8') as f:
+        for line in f:
+            record = json.loads(line)
+            if by == 'day':
+                key = time.strftime('%Y-%m-%d', time.localtime(record['time']))
+            else:
+                key = record.get(by) or '-'
+            groups.setdefault(key, []).append(record)
+
+    # Days read best in order, chats and profiles by how much prompt they use.
+    def prompt_tokens(records):
+        return sum(x['prompt_tokens'] or 0 for x in records)
+
+    if by == 'day':
+        keys = sorted(groups)
+    else:
+        keys = sorted(groups, key=lambda x: prompt_tokens(groups[x]), reverse=True)
+
+    print(f"{'turns':>6} {'prompt':>10} {'completion':>10} {'max prompt':>10} {'ttft p50':>9} {'time':>9}  {by}")
+    for key in keys:
+        records = groups[key]
+        completion = sum(x['completion_tokens'] or 0 for x in records)
+        max_prompt = max(x['prompt_tokens'] or 0 for x in records)
+        ttfts = [x['ttft'] for x in records if x['ttft'] is not None]
+        ttft = f"{percentile(ttfts, 50):8.3f}s" if ttfts else f"{'-':>9}"
+        duration = sum(x['duration'] for x in records)
+        print(f"{len(records):6d} {prompt_tokens(records):10d} {completion:10d} {max_prompt:10d} {ttft} {duration:8.1f}s  {key}")
+
+
+def report_early_stop(stats, data):
+    max_tokens = data.get('max_tokens') or data.get('n_predict')
+    message = f"Stopped early at @{stats['early_stop']} after {stats['chunks']} tokens"
+    if max_tokens and max_tokens > 0:
+        stats['tokens_saved'] = max(max_tokens - stats['chunks'], 0)
+        message += f", saved up to {stats['tokens_saved']} of {max_tokens}"
+    print(f"{message}.", file=sys.stderr)
+
+
+def render_history_html(history):
+    ret = []
+    for message in history:
+        name = html.escape(message.name)
+        content = html.escape(message.content.strip('\n'))
+        ret.append(f'<h3>{name}</h3>\n<pre>{content}</pre>\n')
+    return ''.join(ret)
+
+
+class PreviewHub:
+    # Shares one stream of preview events between all connected browsers. New
+    # viewers start with the rendered history and the current turn so far.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clients = []
+        self.history_html = ''
+        self.deltas = []
+
+    def encode(self, event, data):
+        return f'event: {event}\ndata: {json.dumps(data)}\n\n'.encode('utf-8')
+
+    def subscribe(self):
+        client = queue.Queue()
+        with self.lock:
+            client.put(self.encode('history', self.history_html))
+            if self.deltas:
+                client.put(self.encode('delta', ''.join(self.deltas)))
+            self.clients.append(client)
+        return client
+
+    def unsubscribe(self, client):
+        with self.lock:
+            self.clients.remove(client)
+
+    def publish(self, event, data):
+        message = self.encode(event, data)
+        with self.lock:
+            if event == 'history':
+                self.history_html = data
+                self.deltas = []
+            else:
+                self.deltas.append(data)
+            for client in self.clients:
+                client.put(message)
+
+
+class PreviewHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/':
+            body = PREVIEW_PAGE.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        if self.path != '/events':
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+
+        hub = self.server.hub
+        client = hub.subscribe()
+        try:
+            while True:
+                try:
+                    message = client.get(timeout=PREVIEW_KEEPALIVE_TIME)
+                except queue.Empty:
+                    message = b': keep-alive\n\n'
+                self.wfile.write(message)
+                self.wfile.flush()
+        except OSError:
+            pass
+        finally:
+            hub.unsubscribe(client)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_preview_server(port):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), PreviewHandler)
+    server.daemon_threads = True
+    server.hub = PreviewHub()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Preview at http://127.0.0.1:{port}/", file=sys.stderr)
+    return server.hub
+
+
+class PreviewOutput:
+    # Passes generated text through to the chat and on to the preview.
+    def __init__(self, io_out, hub):
+        self.io_out = io_out
+        self.hub = hub
+
+    def write(self, text):
+        self.io_out.write(text)
+        self.hub.publish('delta', text)
+
+    def flush(self):
+        self.io_out.flush()
+
+
+def run_with_file(path, template_directory, watching=False, preview=None):
+    read_stat = file_stat(path)
+    _, config_content, history = read_chat(path)
+    if template_directory is None:
+        template_directory = os.path.dirname(path)
+
+    # The history is rendered once per file change, generated text is sent to
+    # the preview as deltas.
+    if preview is not None:
+        preview.publish('history', render_history_html(history))
+
+    # While the user is still typing, warm the server's prompt cache instead
+    # of generating.
+    if watching and not is_generation_due(history):
+        config = load_config(os.getcwd(), config_content)
+        if config['prewarm']:
+            # Typing on stops the pre-warm, the edited file is picked up right
+            # away.
+            cancel = StreamCancel()
+            watcher = ChatFileWatcher(path, cancel, read_stat)
+            try:
+                prewarm(config, history, template_directory, path, cancel)
+            except GenerationCancelled:
+                print("pre-warm cancelled.", file=sys.stderr)
+                return True
+            finally:
+                watcher.stop()
+            return False
+
+    if not watching:
+        with open(path, 'a') as f:
+            out = f if preview is None else PreviewOutput(f, preview)
+            generate(out, os.getcwd(), config_content, history, template_directory, chat_path=path)
+        return False
+
+    # Stop the generation as soon as the user edits the file again. Nothing
+    # more is written to it, so it stays exactly as the user saved it.
+    cancel = StreamCancel()
+    with open(path, 'a') as f:
+        appender = ChatFileAppender(path, f, cancel, read_stat)
+        out = appender if preview is None else PreviewOutput(appender, preview)
+        try:
+            generate(out, os.getcwd(), config_content, history, template_directory, cancel, path)
+            # The user postfix isn't flushed by generate.
+            out.flush()
+        except GenerationCancelled:
+            print("request cancelled.", file=sys.stderr)
+            return True
+        finally:
+            appender.stop()
+    return False
+
+
+class EditorBuffer:
+    # A chat kept in memory for an editor. Edits only invalidate the parsed
+    # messages from the first changed offset on.
+    def __init__(self, path, text):
+        self.path = os.path.abspath(path)
+        self.text = text
+        self.line_starts = None
+        self.config_content = None
+        self.history = None
+        self.history_start = None
+        self.changed_from = 0
+
+    def offset(self, position):
+        # Positions are zero based lines and characters, as in LSP but
+        # counting code points.
+        if self.line_starts is None:
+            self.line_starts = [0] + [x.end() for x in re.finditer('\n', self.text)]
+        if position['line'] >= len(self.line_starts):
+            return len(self.text)
+        return min(self.line_starts[position['line']] + position['character'], len(self.text))
+
+    def replace(self, start, end, text):
+        self.text = self.text[:start] + text + self.text[end:]
+        self.line_starts = None
+        self.changed_from = min(self.changed_from, start)
+
+    def edit(self, edit):
+        self.replace(self.offset(edit['range']['start']), self.offset(edit['range']['end']), edit['text'])
+
+    def append(self, text):
+        self.replace(len(self.text), len(self.text), text)
+
+    def parse(self):
+        if self.history is None or self.changed_from < self.history_start:
+            self.config_content, self.history = parse_data_and_chathistory(self.text)
+            self.history_start = front_matter_bounds(self.text)[1] + 4
+        else:
+            self.history = reparse_chathistory(self.history, self.text, self.history_start, self.changed_from)
+        self.changed_from = len(self.text)
+
+        # Generation modifies what it is given, the parse is kept for later.
+        return copy.deepcopy(self.config_content), [x.copy() for x in self.history]
+
+
+class EditorOutput:
+    # Adds generated text to the buffer and streams it to the editor.
+    def __init__(self, server, buffer, cancel):
+        self.server = server
+        self.buffer = buffer
+        self.cancel = cancel
+
+    def write(self, text):
+        with self.server.lock:
+            if self.cancel.cancelled:
+                raise GenerationCancelled()
+            self.buffer.append(text)
+        self.server.notify('output', {'path': self.buffer.path, 'text': text})
+
+    def flush(self):
+        pass
+
+
+class EditorServer:
+    # JSON-RPC 2.0 over stdio with one message per line. The editor sends
+    # edits against buffers kept here and gets generated text as 'output'
+    # notifications, which it inserts without sending them back as edits.
+    PARSE_ERROR = -32700
+    INVALID_REQUEST = -32600
+    METHOD_NOT_FOUND = -32601
+    INVALID_PARAMS = -32602
+    INTERNAL_ERROR = -32603
+    REQUEST_CANCELLED = -32800
+
+    def __init__(self, template_directory, f_out):
+        self.template_directory = template_directory
+        self.f_out = f_out
+        self.out_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.buffers = {}
+        self.generations = {}
+        self.methods = {
+            'open': self.open,
+            'close': self.close,
+            'edit': self.edit,
+            'generate': self.generate,
+            'cancel': self.cancel,
+        }
+
+    def send(self, message):
+        message['jsonrpc'] = '2.0'
+        with self.out_lock:
+            self.f_out.write(json.dumps(message) + '\n')
+            self.f_out.flush()
+
+    def notify(self, method, params):
+        self.send({'method': method, 'params': params})
+
+    def respond(self, request_id, result):
+        if request_id is not None:
+            self.send({'id': request_id, 'result': result})
+
+    def respond_error(self, request_id, code, message):
+        if request_id is not None:
+            self.send({'id': request_id, 'error': {'code': code, 'message': message}})
+
+    def handle_line(self, line):
+        try:
+            message = json.loads(line)
+        except ValueError as e:
+            self.send({'id': None, 'error': {'code': self.PARSE_ERROR, 'message': str(e)}})
+            return
+
+        # Batches aren't supported.
+        if not isinstance(message, dict):
+            self.send({'id': None, 'error': {'code': self.INVALID_REQUEST, 'message': "expected a request object"}})
+            return
+
+        request_id = message.get('id')
+        method = self.methods.get(message.get('method'))
+        if method is None:
+            self.respond_error(request_id, self.METHOD_NOT_FOUND, f"unknown method: {message.get('method')}")
+            return
+
+        try:
+            method(request_id, message.get('params', {}))
+        except (KeyError, TypeError) as e:
+            self.respond_error(request_id, self.INVALID_PARAMS, f"invalid params: {e!r}")
+        except Exception as e:
+            self.respond_error(request_id, self.INTERNAL_ERROR, repr(e))
+
+    def open(self, request_id, params):
+        buffer = EditorBuffer(params['path'], params['text'])
+        self.stop_generation(buffer.path)
+        with self.lock:
+            self.buffers[buffer.path] = buffer
+        self.respond(request_id, None)
+
+    def close(self, request_id, params):
+        path = os.path.abspath(params['path'])
+        self.stop_generation(path)
+        with self.lock:
+            del self.buffers[path]
+        self.respond(request_id, None)
+
+    def edit(self, request_id, params):
+        # Editing a chat stops its generation, like saving a watched file.
+        path = os.path.abspath(params['path'])
+        self.stop_generation(path)
+        with self.lock:
+            buffer = self.buffers[path]
+            for edit in params['edits']:
+                buffer.edit(edit)
+        self.respond(request_id, None)
+
+    def cancel(self, request_id, params):
+        self.stop_generation(os.path.abspath(params['path']))
+        self.respond(request_id, None)
+
+    def stop_generation(self, path):
+        with self.lock:
+            running = self.generations.get(path)
+        if running is not None:
+            running[0].cancel()
+
+    def stop_all(self):
+        with self.lock:
+            running = list(self.generations.values())
+        for cancel, thread in running:
+            cancel.cancel()
+            thread.join()
+
+    def generate(self, request_id, params):
+        path = os.path.abspath(params['path'])
+        with self.lock:
+            buffer = self.buffers[path]
+            previous = self.generations.get(path)
+            if previous is not None and not previous[0].cancelled:
+                raise RuntimeError(f"already generating: {path}")
+            cancel = StreamCancel()
+
+            # The response is sent once the generation is done.
+            args = (request_id, buffer, previous, cancel)
+            thread = threading.Thread(target=self.run_generation, args=args, daemon=True)
+            self.generations[path] = (cancel, thread)
+        thread.start()
+
+    def run_generation(self, request_id, buffer, previous, cancel):
+        # An edit usually comes right before the next turn, let the generation
+        # it cancelled wind down first. Waiting here keeps other buffers and
+        # requests going meanwhile.
+        if previous is not None:
+            previous[1].join()
+
+        # The config is found from the working directory, as in every other
+        # mode, templates default to the chat's directory.
+        template_directory = self.template_directory
+        if template_directory is None:
+            template_directory = os.path.dirname(buffer.path)
+
+        out = EditorOutput(self, buffer, cancel)
+        error = None
+        try:
+            with self.lock:
+                if cancel.cancelled:
+                    raise GenerationCancelled()
+                config_content, history = buffer.parse()
+            # Concurrent generations would clobber each other's debug files.
+            config_content['write_debug_files'] = False
+            stats = generate(out, os.getcwd(), config_content, history, template_directory, cancel, buffer.path)
+        except GenerationCancelled:
+            print("request cancelled.", file=sys.stderr)
+            error = (self.REQUEST_CANCELLED, "generation cancelled")
+        except Exception as e:
+            error = (self.INTERNAL_ERROR, repr(e))
+
+        # A later generation may already be waiting on this one.
+        with self.lock:
+            if self.generations[buffer.path][0] is cancel:
+                del self.generations[buffer.path]
+
+        if error is None:
+            self.respond(request_id, stats)
+        else:
+            self.respond_error(request_id, *error)
 
-def run_with_file(path, template_directory):
+
+def run_editor(template_directory):
+    server = EditorServer(template_directory, sys.stdout)
+    for line in sys.stdin:
+        if line.strip():
+            server.handle_line(line)
+    server.stop_all()
+
+
+def list_batch_paths(target):
+    if os.path.isdir(target):
+        names = sorted(x for x in os.listdir(target) if x.endswith('.txt'))
+        return [(os.path.join(target, x), x) for x in names]
+
+    # Otherwise a manifest with one chat path per line, relative to itself.
+    base_dir = os.path.dirname(target)
+    ret = []
+    with open(target, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            path = os.path.join(base_dir, line)
+            ret.append((path, os.path.relpath(path, base_dir or os.curdir)))
+    return ret
+
+
+def is_within_directory(directory, path):
+    directory = os.path.abspath(directory)
+    return os.path.commonpath([directory, os.path.abspath(path)]) == directory
+
+
+def run_batch_item(path, template_directory):
     with open(path, 'r', encoding='utf-8') as f:
         content = f.read()
     config_content, history = parse_data_and_chathistory(content)
-    with open(path, 'a') as f:
-        if template_directory is None:
-            template_directory = os.path.dirname(path)
-        generate(f, os.getcwd(), config_content, history, template_directory)
+    if template_directory is None:
+        template_directory = os.path.dirname(path)
+
+    # Concurrent requests would clobber each other's debug files.
+    config_content['write_debug_files'] = False
+
+    out = io.StringIO()
+    stats = generate(out, os.getcwd(), config_content, history, template_directory, chat_path=path)
+    return content, out.getvalue(), stats
+
+
+def percentile(values, p):
+    values = sorted(values)
+    index = max(math.ceil(p / 100 * len(values)) - 1, 0)
+    return values[index]
+
+
+def run_batch(target, output, concurrency, template_directory):
+    paths = list_batch_paths(target)
+    to_jsonl = output.endswith('.jsonl')
+
+    # Batch mode never writes outside the output directory or over a chat.
+    if not to_jsonl:
+        for path, name in paths:
+            out_path = os.path.join(output, name)
+            if not is_within_directory(output, out_path) or os.path.abspath(out_path) == os.path.abspath(path):
+                raise ValueError(f"{path}: output {out_path} is not inside {output} or overwrites the chat")
+
+    if to_jsonl:
+        out_file = open(output, 'w', encoding='utf-8')
+    else:
+        os.makedirs(output, exist_ok=True)
+
+    results = []
+    failures = 0
+    batch_start = time.monotonic()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {
+            executor.submit(run_batch_item, path, template_directory): (path, name)
+            for path, name in paths
+        }
+        for future in concurrent.futures.as_completed(futures):
+            path, name = futures[future]
+            try:
+                content, generated, stats = future.result()
+            except Exception as e:
+                print(f"{path}: {e!r}", file=sys.stderr)
+                failures += 1
+                if to_jsonl:
+                    out_file.write(json.dumps({'path': path, 'error': repr(e)}) + '\n')
+                continue
+
+            # Inactive chats are skipped by generate().
+            if stats is None:
+                continue
+            results.append((generated, stats))
+
+            if to_jsonl:
+                record = {'path': path, 'output': generated}
+                record.update(stats)
+                out_file.write(json.dumps(record) + '\n')
+            else:
+                out_path = os.path.join(output, name)
+                os.makedirs(os.path.dirname(out_path), exist_ok=True)
+                with open(out_path, 'w', encoding='utf-8') as f:
+                    f.write(content)
+                    f.write(generated)
+
+    elapsed = time.monotonic() - batch_start
+    if to_jsonl:
+        out_file.close()
+
+    generated_chars = sum(len(x[0]) for x in results)
+    print(f"Batch finished: {len(results)} ok, {failures} failed in {elapsed:.1f}s "
+          f"({len(results) / elapsed:.2f} chats/s, {generated_chars / elapsed:.1f} chars/s)",
+          file=sys.stderr)
+
+    for key in ('ttft', 'duration'):
+        values = [x[1][key] for x in results if x[1][key] is not None]
+        if not values:
+            continue
+        summary = '  '.join(f'p{p} {percentile(values, p):.3f}s' for p in (50, 90, 99))
+        print(f"{key:<8} {summary}", file=sys.stderr)
 
 
 def main():
@@ -675,16 +2539,64 @@ def main():
     parser.add_argument('path', nargs='?')
     parser.add_argument('-w', '--watch')
     parser.add_argument('-t', '--template-directory')
+    parser.add_argument('-b', '--batch')
+    parser.add_argument('-o', '--output')
+    parser.add_argument('-j', '--concurrency', type=int, default=4)
+    parser.add_argument('-a', '--archive')
+    parser.add_argument('-p', '--preview', type=int)
+    parser.add_argument('-u', '--usage', choices=['day', 'chat', 'profile'])
+    parser.add_argument('-e', '--editor', action='store_true')
+    parser.add_argument('--profile-memory', action='store_true')
     args = parser.parse_args()
 
+    if args.usage is not None:
+        ledger_path = args.path
+        if ledger_path is None:
+            ledger_path = load_config(os.getcwd(), {})['usage_ledger_file']
+        if ledger_path is None:
+            parser.error("no usage ledger, set usage_ledger_file or pass the ledger path")
+        summarize_usage(ledger_path, args.usage)
+        return
+
+    if args.profile_memory:
+        MEMORY_PROFILER.start()
+
+    preview = None
+    if args.preview is not None:
+        preview = start_preview_server(args.preview)
+
+    if args.editor:
+        run_editor(args.template_directory)
+        return
+
+    if args.archive is not None:
+        with open(args.archive, 'r', encoding='utf-8') as f:
+            config_content, _ = parse_data_and_chathistory(f.read())
+        config = load_config(os.getcwd(), config_content)
+        archive_chat(args.archive, config['archive_keep'], config['archive_compression'])
+        return
+
+    if args.batch is not None:
+        assert(args.path is None and args.watch is None)
+        assert(args.output is not None)
+        run_batch(args.batch, args.output, args.concurrency, args.template_directory)
+        return
+
     if args.watch is not None:
         assert(args.path is None)
         for path in watch_and_do(args.watch):
-            run_with_file(path, args.template_directory)
+            # A cancelled turn is restarted right away with the edited file.
+            cancelled = True
+            while cancelled:
+                cancelled = run_with_file(path, args.template_directory, watching=True, preview=preview)
+                if args.profile_memory:
+                    MEMORY_PROFILER.report()
 
     if args.path is not None:
         assert(args.watch is None)
-        run_with_file(args.path, args.template_directory)
+        run_with_file(args.path, args.template_directory, preview=preview)
+        if args.profile_memory:
+            MEMORY_PROFILER.report()
 
     if args.watch is None and args.path is None:
         template_directory = args.template_directory
@@ -693,6 +2605,8 @@ def main():
         all_stdin_data = sys.stdin.read()
         config_content, history = parse_data_and_chathistory(all_stdin_data)
         generate(sys.stdout, os.getcwd(), config_content, history, template_directory)
+        if args.profile_memory:
+            MEMORY_PROFILER.report()
 
 if __name__ == "__main__":
     main()